@@ -1,14 +1,54 @@
 #!/usr/bin/env python3
 import os
+import re
 import asyncio
-import requests
-from datetime import datetime
-from fastapi import FastAPI, HTTPException
+import hashlib
+import time
+import httpx
+import orjson
+from contextlib import asynccontextmanager
+from aiolimiter import AsyncLimiter
+from datetime import datetime, timezone
+from itertools import islice
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Dict, Any
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Annotated, Dict, Any, Optional
 
-app = FastAPI(title="Weather MCP Server", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Clients are created here so each worker builds its own inside its
+    # event loop. The shared HTTP client keeps OpenWeatherMap calls off the
+    # event loop and reuses connections; HTTP/2 multiplexes concurrent
+    # calls over one TLS connection.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=100, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(10.0, connect=3.0),
+    )
+    # Short timeouts make a stuck Redis raise TimeoutError, which is
+    # treated as a cache miss
+    if REDIS_URL:
+        app.state.redis = redis.from_url(REDIS_URL, socket_connect_timeout=0.5, socket_timeout=0.5)
+    else:
+        app.state.redis = None
+    yield
+    await app.state.http.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+app = FastAPI(
+    title="Weather MCP Server",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+# Compress larger responses for clients that accept gzip. Added before
+# CORS so the CORS middleware stays outermost.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # Enable CORS for trusted frontend only (adjust domain as needed)
 TRUSTED_ORIGINS = ["http://localhost:8080"]
@@ -17,94 +57,356 @@ app.add_middleware(
     allow_origins=TRUSTED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,
 )
 
 # Get OpenWeatherMap API key
-OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
+OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY", "").strip()
 if not OPENWEATHER_API_KEY:
     raise RuntimeError("OPENWEATHER_API_KEY environment variable is required.")
 
+# OpenWeatherMap endpoints and the query parameters shared by every call
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+FORECAST_URL = "https://api.openweathermap.org/data/2.5/forecast"
+BASE_PARAMS = {"appid": OPENWEATHER_API_KEY, "units": "metric"}
+
+def default_worker_count() -> int:
+    """One worker per usable core, capped at 4. os.cpu_count() reports the
+    host's cores inside containers; the affinity mask at least honours
+    cpusets, and the cap keeps large hosts from spawning dozens of workers."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    return min(cores, 4)
+
+# uvicorn worker processes started by __main__
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", default_worker_count()))
+if WEB_CONCURRENCY < 1:
+    raise RuntimeError("WEB_CONCURRENCY must be at least 1.")
+
+# Stay under the OpenWeatherMap plan's calls-per-minute cap (60 on the
+# free tier). With Redis the budget is shared by all workers through a
+# per-minute counter. Without it each process takes an equal share, based
+# on the WEB_CONCURRENCY environment variable: __main__ exports it before
+# starting its workers and uvicorn's CLI reads it as its worker count, so
+# when it is unset this is a single process. Callers wait at most
+# RATE_LIMIT_WAIT seconds for a slot.
+OPENWEATHER_CALLS_PER_MINUTE = int(os.getenv("OPENWEATHER_CALLS_PER_MINUTE", "60"))
+if OPENWEATHER_CALLS_PER_MINUTE < 1:
+    raise RuntimeError("OPENWEATHER_CALLS_PER_MINUTE must be at least 1.")
+RATE_LIMIT_WAIT = 5.0
+calls_per_worker = OPENWEATHER_CALLS_PER_MINUTE / int(os.getenv("WEB_CONCURRENCY", "1"))
+# The limiter needs room for at least one call, so below one call a
+# minute the period is stretched instead
+limiter_capacity = max(calls_per_worker, 1)
+openweather_limiter = AsyncLimiter(limiter_capacity, 60 * limiter_capacity / calls_per_worker)
+
+# Successful results are cached per city. Current conditions change every
+# few minutes upstream, forecasts roughly hourly. The stale copies keep the
+# last good result for a day so it can be served if OpenWeatherMap fails.
+CACHE_TTLS = {
+    "current": 300,
+    "forecast": 3600,
+    "stale:current": 86400,
+    "stale:forecast": 86400,
+}
+
+# Use Redis when configured so every worker shares one cache, otherwise
+# fall back to in-process TTL caches. The client lives on app.state.redis.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as redis
+local_caches = {kind: TTLCache(maxsize=512, ttl=ttl) for kind, ttl in CACHE_TTLS.items()}
+
+# Upstream fetches in progress, keyed like the cache, and how many callers
+# are currently awaiting each one
+inflight: Dict[str, asyncio.Task] = {}
+inflight_waiters: Dict[asyncio.Task, int] = {}
+
+# strftime formats used when rendering responses
+DATE_FORMAT = "%Y-%m-%d"
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DAY_NAME_FORMAT = "%A"
+
+SECONDS_PER_DAY = 24 * 60 * 60
+LOCAL_NOON_SECONDS = 12 * 60 * 60
+
+# Chat reply for get_weather, filled from weather_info plus "updated"
+CURRENT_WEATHER_TEMPLATE = """🌤️ Current Weather for {city}, {country}:
+
+🌡️ Temperature: {temperature} (feels like {feels_like})
+☁️ Condition: {condition}
+💧 Humidity: {humidity}
+🌪️ Pressure: {pressure}
+💨 Wind Speed: {wind_speed}
+
+Data updated: {updated}"""
+
+
 class WeatherRequest(BaseModel):
-    city: str
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    city: Annotated[str, Field(min_length=1)]
+
+# Basic validation: only allow letters, spaces, and hyphens
+CITY_PATTERN = re.compile(r'^[A-Za-z\s\-]{2,50}$')
 
 def validate_city(city: str) -> str:
-    # Basic validation: only allow letters, spaces, and hyphens
-    import re
-    if not re.match(r'^[A-Za-z\s\-]{2,50}$', city):
+    if not CITY_PATTERN.match(city):
         raise HTTPException(status_code=400, detail="Invalid city name.")
     return city.strip()
 
+class UpstreamRateLimited(Exception):
+    """No OpenWeatherMap call slot became free within RATE_LIMIT_WAIT"""
+
+# Failures of an OpenWeatherMap call: HTTP/transport errors, an exhausted
+# call budget, plus a body that isn't JSON or lacks the fields we read
+UPSTREAM_ERRORS = (
+    httpx.HTTPError,
+    UpstreamRateLimited,
+    orjson.JSONDecodeError,
+    KeyError,
+    IndexError,
+    TypeError,
+)
+
+def is_upstream_outage(error: Exception) -> bool:
+    """True for failures a stale result can cover: transport errors,
+    timeouts, malformed payloads, rate limiting and 5xx. Client errors such as a bad API key
+    must surface instead of being hidden behind cached data."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return True
+
+def upstream_error(error: Exception, message: str) -> HTTPException:
+    """Map an OpenWeatherMap failure to the status code returned to the caller"""
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 404:
+        status_code = 404
+    elif isinstance(error, httpx.TimeoutException):
+        status_code = 504
+    elif isinstance(error, UpstreamRateLimited):
+        status_code = 503
+    else:
+        status_code = 502
+    return HTTPException(status_code=status_code, detail=message)
+
 class ToolRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     tool_name: str
-    parameters: Dict[str, Any]
+    parameters: WeatherRequest
+
+class WeatherInfo(BaseModel):
+    city: str
+    country: str
+    temperature: str
+    feels_like: str
+    condition: str
+    humidity: str
+    pressure: str
+    wind_speed: str
+    timestamp: str
+
+# Result of /tools/execute; declared as the response model so FastAPI
+# serializes it through pydantic-core
+class ToolResult(BaseModel):
+    success: bool
+    formatted_response: str
+    data: Optional[WeatherInfo] = None
+    stale: Optional[bool] = None
+
+# Static tool catalogue served by /tools
+TOOLS_RESPONSE = {
+    "tools": [
+        {
+            "name": "get_weather",
+            "description": "Get current weather information for a city",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "city": {
+                        "type": "string",
+                        "description": "The name of the city"
+                    }
+                },
+                "required": ["city"]
+            }
+        },
+        {
+            "name": "get_forecast",
+            "description": "Get 5-day weather forecast for a city",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "city": {
+                        "type": "string",
+                        "description": "The name of the city"
+                    }
+                },
+                "required": ["city"]
+            }
+        }
+    ]
+}
+
+TOOLS_JSON = orjson.dumps(TOOLS_RESPONSE)
+TOOLS_HEADERS = {
+    "Cache-Control": "public, max-age=3600",
+    "ETag": f'"{hashlib.sha256(TOOLS_JSON).hexdigest()[:16]}"',
+}
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag (RFC 9110)"""
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def cache_key(kind: str, city: str) -> str:
+    return f"wx:{kind}:{city.lower()}"
+
+async def cache_get(kind: str, city: str):
+    """Return a cached tool result, or None on a miss"""
+    redis_client = app.state.redis
+    key = cache_key(kind, city)
+    if redis_client is None:
+        return local_caches[kind].get(key)
+    try:
+        cached = await redis_client.get(key)
+    except redis.RedisError:
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+async def cache_set(kind: str, city: str, result: Dict[str, Any]):
+    """Store a fresh result along with its longer-lived stale copy"""
+    redis_client = app.state.redis
+    kinds = (kind, f"stale:{kind}")
+    if redis_client is None:
+        for k in kinds:
+            local_caches[k][cache_key(k, city)] = result
+        return
+    payload = orjson.dumps(result)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for k in kinds:
+                pipe.set(cache_key(k, city), payload, ex=CACHE_TTLS[k])
+            await pipe.execute()
+    except redis.RedisError:
+        pass
+
+async def acquire_upstream_slot():
+    """Wait for a slot in the OpenWeatherMap call budget, raising
+    UpstreamRateLimited if none frees up within RATE_LIMIT_WAIT"""
+    redis_client = app.state.redis
+    if redis_client is not None:
+        deadline = time.monotonic() + RATE_LIMIT_WAIT
+        while True:
+            window, elapsed = divmod(time.time(), 60)
+            key = f"ratelimit:openweather:{int(window)}"
+            try:
+                async with redis_client.pipeline(transaction=True) as pipe:
+                    pipe.incr(key)
+                    pipe.expire(key, 120)
+                    calls, _ = await pipe.execute()
+            except redis.RedisError:
+                # Redis unavailable: fall back to the per-process limiter
+                break
+            if calls <= OPENWEATHER_CALLS_PER_MINUTE:
+                return
+            retry_in = 60 - elapsed
+            if time.monotonic() + retry_in > deadline:
+                raise UpstreamRateLimited()
+            await asyncio.sleep(retry_in)
+    try:
+        await asyncio.wait_for(openweather_limiter.acquire(), RATE_LIMIT_WAIT)
+    except asyncio.TimeoutError:
+        raise UpstreamRateLimited() from None
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Dependency returning the shared OpenWeatherMap client from app state"""
+    return request.app.state.http
+
+def finish_fetch(key: str, task: asyncio.Task):
+    """Done callback: forget the fetch and retrieve its exception so a
+    failure nobody awaited isn't logged as never retrieved"""
+    if inflight.get(key) is task:
+        del inflight[key]
+    if not task.cancelled():
+        task.exception()
+
+async def coalesce(kind: str, city: str, fetch, client: httpx.AsyncClient):
+    """Share one upstream fetch between concurrent requests for the same city"""
+    key = cache_key(kind, city)
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch(city, client))
+        inflight[key] = task
+        task.add_done_callback(lambda t: finish_fetch(key, t))
+    inflight_waiters[task] = inflight_waiters.get(task, 0) + 1
+    try:
+        # Shield so a cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+    finally:
+        inflight_waiters[task] -= 1
+        if not inflight_waiters[task]:
+            del inflight_waiters[task]
+            # Every caller has gone; stop spending rate budget on the fetch
+            if not task.done():
+                task.cancel()
+                if inflight.get(key) is task:
+                    del inflight[key]
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 @app.get("/tools")
-async def list_tools():
+async def list_tools(request: Request):
     """List available MCP tools"""
-    return {
-        "tools": [
-            {
-                "name": "get_weather",
-                "description": "Get current weather information for a city",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "city": {
-                            "type": "string",
-                            "description": "The name of the city"
-                        }
-                    },
-                    "required": ["city"]
-                }
-            },
-            {
-                "name": "get_forecast",
-                "description": "Get 5-day weather forecast for a city",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "city": {
-                            "type": "string",
-                            "description": "The name of the city"
-                        }
-                    },
-                    "required": ["city"]
-                }
-            }
-        ]
-    }
+    if etag_matches(request.headers.get("if-none-match", ""), TOOLS_HEADERS["ETag"]):
+        return Response(status_code=304, headers=TOOLS_HEADERS)
+    return Response(content=TOOLS_JSON, media_type="application/json", headers=TOOLS_HEADERS)
 
-@app.post("/tools/execute")
-async def execute_tool(request: ToolRequest):
+@app.post("/tools/execute", response_model=ToolResult, response_model_exclude_none=True)
+async def execute_tool(
+    request: ToolRequest,
+    response: Response,
+    client: httpx.AsyncClient = Depends(get_http_client),
+):
     """Execute a specific MCP tool"""
     try:
-        if request.tool_name == "get_weather":
-            return await get_current_weather(request.parameters["city"])
-        elif request.tool_name == "get_forecast":
-            return await get_weather_forecast(request.parameters["city"])
-        else:
+        handler = TOOL_HANDLERS.get(request.tool_name)
+        if handler is None:
             raise HTTPException(status_code=400, detail=f"Unknown tool: {request.tool_name}")
+        result = await handler(request.parameters.city, client)
+        # Results served from the stale copy during an upstream outage
+        if result.get("stale"):
+            response.headers["X-Cache"] = "STALE"
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def get_current_weather(city: str):
+async def get_current_weather(city: str, client: httpx.AsyncClient):
     """Get current weather from OpenWeatherMap API"""
     city = validate_city(city)
+    cached = await cache_get("current", city)
+    if cached is not None:
+        return cached
+    return await coalesce("current", city, fetch_current_weather, client)
+
+async def fetch_current_weather(city: str, client: httpx.AsyncClient):
+    """Fetch current weather from OpenWeatherMap and cache it"""
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather"
-        params = {
-            "q": city,
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric"
-        }
-        response = requests.get(url, params=params)
+        params = {**BASE_PARAMS, "q": city}
+        await acquire_upstream_slot()
+        response = await client.get(WEATHER_URL, params=params)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
+        now = datetime.now()
         weather_info = {
             "city": data["name"],
             "country": data["sys"]["country"],
@@ -114,64 +416,88 @@ async def get_current_weather(city: str):
             "humidity": f"{data['main']['humidity']}%",
             "pressure": f"{data['main']['pressure']} hPa",
             "wind_speed": f"{data['wind']['speed']} m/s",
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now.isoformat()
         }
-        return {
+        result = {
             "success": True,
             "data": weather_info,
-            "formatted_response": f"""🌤️ Current Weather for {weather_info['city']}, {weather_info['country']}:
-
-🌡️ Temperature: {weather_info['temperature']} (feels like {weather_info['feels_like']})
-☁️ Condition: {weather_info['condition']}
-💧 Humidity: {weather_info['humidity']}
-🌪️ Pressure: {weather_info['pressure']}
-💨 Wind Speed: {weather_info['wind_speed']}
-
-Data updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
-        }
-    except requests.RequestException:
-        return {
-            "success": False,
-            "error": "Failed to fetch weather data.",
-            "formatted_response": f"Sorry, I couldn't get weather data for {city}. Please check the city name and try again."
+            "formatted_response": CURRENT_WEATHER_TEMPLATE.format_map(
+                {**weather_info, "updated": now.strftime(DATETIME_FORMAT)}
+            )
         }
+        await cache_set("current", city, result)
+        return result
+    except UPSTREAM_ERRORS as e:
+        if is_upstream_outage(e):
+            stale = await cache_get("stale:current", city)
+            if stale is not None:
+                return {**stale, "stale": True}
+        raise upstream_error(e, f"Sorry, I couldn't get weather data for {city}. Please check the city name and try again.")
 
-async def get_weather_forecast(city: str):
+async def get_weather_forecast(city: str, client: httpx.AsyncClient):
     """Get 5-day weather forecast"""
     city = validate_city(city)
+    cached = await cache_get("forecast", city)
+    if cached is not None:
+        return cached
+    return await coalesce("forecast", city, fetch_weather_forecast, client)
+
+async def fetch_weather_forecast(city: str, client: httpx.AsyncClient):
+    """Fetch the 5-day forecast from OpenWeatherMap and cache it"""
     try:
-        url = f"https://api.openweathermap.org/data/2.5/forecast"
-        params = {
-            "q": city,
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric"
-        }
-        response = requests.get(url, params=params)
+        params = {**BASE_PARAMS, "q": city}
+        await acquire_upstream_slot()
+        response = await client.get(FORECAST_URL, params=params)
         response.raise_for_status()
-        data = response.json()
-        forecast_text = f"📅 5-Day Weather Forecast for {data['city']['name']}, {data['city']['country']}:\n\n"
-        # Group by date and take one forecast per day
+        data = orjson.loads(response.content)
+        lines = [f"📅 5-Day Weather Forecast for {data['city']['name']}, {data['city']['country']}:", ""]
+        # Pick the entry closest to local noon for each of the next 5 days.
+        # OpenWeatherMap gives the city's UTC offset in seconds, so days are
+        # split at the city's midnight with integer arithmetic and only the
+        # kept entries are turned into datetimes.
+        utc_offset = data['city']['timezone']
         daily_forecasts = {}
-        for item in data['list'][:5]:  # First 5 entries
-            date = datetime.fromtimestamp(item['dt']).strftime('%Y-%m-%d')
-            if date not in daily_forecasts:
-                daily_forecasts[date] = item
-        for date, forecast in daily_forecasts.items():
-            day_name = datetime.fromtimestamp(forecast['dt']).strftime('%A')
+        for item in data['list']:
+            local_ts = item['dt'] + utc_offset
+            day, seconds = divmod(local_ts, SECONDS_PER_DAY)
+            distance = abs(seconds - LOCAL_NOON_SECONDS)
+            best = daily_forecasts.get(day)
+            if best is None or distance < best[0]:
+                daily_forecasts[day] = (distance, item)
+        for _, forecast in islice(daily_forecasts.values(), 5):
+            forecast_time = datetime.fromtimestamp(forecast['dt'] + utc_offset, tz=timezone.utc)
+            date = forecast_time.strftime(DATE_FORMAT)
+            day_name = forecast_time.strftime(DAY_NAME_FORMAT)
             temp = forecast['main']['temp']
             desc = forecast['weather'][0]['description'].title()
-            forecast_text += f"🗓️ {day_name} ({date}): {temp}°C, {desc}\n"
-        return {
+            lines.append(f"🗓️ {day_name} ({date}): {temp}°C, {desc}")
+        result = {
             "success": True,
-            "formatted_response": forecast_text
-        }
-    except requests.RequestException:
-        return {
-            "success": False,
-            "error": "Failed to fetch forecast data.",
-            "formatted_response": f"Sorry, I couldn't get forecast data for {city}."
+            "formatted_response": "\n".join(lines) + "\n"
         }
+        await cache_set("forecast", city, result)
+        return result
+    except UPSTREAM_ERRORS as e:
+        if is_upstream_outage(e):
+            stale = await cache_get("stale:forecast", city)
+            if stale is not None:
+                return {**stale, "stale": True}
+        raise upstream_error(e, f"Sorry, I couldn't get forecast data for {city}.")
+
+# Tool name -> handler used by /tools/execute
+TOOL_HANDLERS = {
+    "get_weather": get_current_weather,
+    "get_forecast": get_weather_forecast,
+}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3001)
+    # Tell the workers how many of them share the call budget
+    os.environ["WEB_CONCURRENCY"] = str(WEB_CONCURRENCY)
+    # Workers need the app as an import string
+    uvicorn.run(
+        "weather_server_http:app",
+        host="0.0.0.0",
+        port=3001,
+        workers=WEB_CONCURRENCY,
+    )